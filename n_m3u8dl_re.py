@@ -1,22 +1,282 @@
 import os
 import sys
+import shutil
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import m3u8
 import threading
 import subprocess
 import json
 import re
 import time
+import struct
+import math
+import itertools
+import errno
+import tempfile
+import contextlib
 import concurrent.futures
 from tqdm import tqdm
+from fractions import Fraction
 from urllib.parse import urljoin, urlparse
-from Crypto.Cipher import AES
 import xml.etree.ElementTree as ET
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+MPD_NS = 'urn:mpeg:dash:schema:mpd:2011'
+if etree is not None:
+    MPD_PARSER = etree.XMLParser(huge_tree=True, remove_blank_text=True)
+    # Compiled once; used for manifests in the standard MPD namespace
+    MPD_XPATHS = {path: etree.XPath(path, namespaces={'mpd': MPD_NS}) for path in (
+        'mpd:Period', './/mpd:AdaptationSet', 'mpd:Representation', 'mpd:SegmentTemplate', 'mpd:SegmentTimeline', 'mpd:S')}
+
+TEMPLATE_TOKEN = re.compile(r'\$(RepresentationID|Time|Number|Bandwidth)(%0\d+d)?\$')
+ISO_DURATION = re.compile(r'P(?:([\d.]+)D)?(?:T(?:([\d.]+)H)?(?:([\d.]+)M)?(?:([\d.]+)S)?)?')
+
+def fill_template(template, values):
+    # One pass over the SegmentTemplate identifiers in values; the rest are left in place
+    def sub(match):
+        name, fmt = match.groups()
+        if name not in values: return match.group(0)
+        value = values[name]
+        return fmt % value if fmt and isinstance(value, int) else str(value)
+    return TEMPLATE_TOKEN.sub(sub, template)
+
+def parse_duration(value):
+    # ISO 8601 durations as used by MPD attributes (PnDTnHnMnS), in exact seconds
+    match = ISO_DURATION.fullmatch(value.strip()) if value else None
+    if not match: return None
+    days, hours, minutes, seconds = (Fraction(g) if g else 0 for g in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+# Segments larger than this are fetched as up to RANGE_PARTS parallel byte ranges
+RANGE_SPLIT_SIZE = 4 * 1024 * 1024
+RANGE_PARTS = 8
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+def parse_content_range(value):
+    # (first, last, total) from a Content-Range header, or None if it is missing or open-ended
+    match = CONTENT_RANGE.fullmatch(value.strip()) if value else None
+    return tuple(int(g) for g in match.groups()) if match else None
+
+Cipher = algorithms = modes = None
+
+def load_cryptography():
+    # Imported on first in-process decrypt, so runs without keys never load it
+    global Cipher, algorithms, modes
+    if Cipher is None:
+        with contextlib.suppress(ImportError):
+            from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    return Cipher is not None
+
+MP4_CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'mvex', b'sinf', b'schi'}
+# Bytes of fixed fields before the child boxes of a protected sample entry
+MP4_SAMPLE_ENTRY_SIZES = {b'encv': 78, b'enca': 28}
+
+def iter_boxes(buf, start, end):
+    # Yield (type, box_start, payload_start, box_end) for each MP4 box in buf[start:end]
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', buf, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise ValueError(f"Malformed {box_type!r} box at offset {pos}")
+        yield box_type, pos, pos + header, pos + size
+        pos += size
+
+def walk_boxes(buf, start, end, visit):
+    # Call visit(type, box_start, payload_start, box_end) for every box of an init segment, depth first
+    for box_type, box_start, body, box_end in iter_boxes(buf, start, end):
+        visit(box_type, box_start, body, box_end)
+        if box_type in MP4_CONTAINERS:
+            walk_boxes(buf, body, box_end, visit)
+        elif box_type == b'stsd':
+            walk_boxes(buf, body + 8, box_end, visit)
+        elif box_type in MP4_SAMPLE_ENTRY_SIZES:
+            skip = MP4_SAMPLE_ENTRY_SIZES[box_type]
+            if box_type == b'enca':
+                # QuickTime sound sample description versions 1 and 2 carry extra fields
+                skip += {1: 16, 2: 36}.get(struct.unpack_from('>H', buf, body + 8)[0], 0)
+            walk_boxes(buf, body + skip, box_end, visit)
+
+class CencDecryptor:
+    # In-process decryption of 'cenc' (AES-CTR) and 'cbcs' (AES-CBC pattern) fragmented MP4.
+    # Box sizes never change: samples are decrypted in place, protected sample entries get their
+    # original format back and protection boxes become 'free', so every offset stays valid.
+    SCHEMES = {b'cenc', b'cbcs'}
+
+    def __init__(self, tracks, sample_sizes):
+        self.tracks = tracks
+        self.sample_sizes = sample_sizes
+
+    @classmethod
+    def from_init(cls, init, keys):
+        # None means the stream needs an external tool: unknown scheme, missing key or no cryptography
+        if not load_cryptography():
+            return None
+        keys_by_kid = {}
+        for k in keys:
+            kid, _, key = k.rpartition(':')
+            keys_by_kid[kid.replace('-', '').lower()] = bytes.fromhex(key)
+
+        tracks, sample_sizes, current = {}, {}, {}
+        def visit(box_type, start, body, end):
+            if box_type == b'tkhd':
+                current['id'] = struct.unpack_from('>I', init, body + (20 if init[body] == 1 else 12))[0]
+            elif box_type == b'schm':
+                current['scheme'] = bytes(init[body + 4:body + 8])
+            elif box_type == b'tenc':
+                # A tenc with no track header before it, or too short for its fields, is unusable here
+                if 'id' not in current:
+                    raise ValueError(f"tenc box at offset {start} comes before any tkhd")
+                if end - body < 24 or (init[body + 7] == 0 and end - body < 25 + init[body + 24]):
+                    raise ValueError(f"Short tenc box at offset {start}")
+                pattern, iv_size = init[body + 5], init[body + 7]
+                kid = init[body + 8:body + 24].hex()
+                tracks[current['id']] = {
+                    'scheme': current.get('scheme'),
+                    'key': keys_by_kid.get(kid) or keys_by_kid.get(''),
+                    'iv_size': iv_size,
+                    'constant_iv': bytes(init[body + 25:body + 25 + init[body + 24]]) if iv_size == 0 else None,
+                    'crypt': pattern >> 4 if init[body] else 0,
+                    'skip': pattern & 0xf if init[body] else 0,
+                }
+            elif box_type == b'trex':
+                track_id, size = struct.unpack_from('>I8xI', init, body + 4)
+                sample_sizes[track_id] = size
+        for box_type, start, body, end in iter_boxes(init, 0, len(init)):
+            if box_type == b'moov':
+                walk_boxes(init, body, end, visit)
+
+        if not tracks or any(t['scheme'] not in cls.SCHEMES or not t['key'] for t in tracks.values()):
+            return None
+        return cls(tracks, sample_sizes)
+
+    def process(self, buf):
+        # Decrypt a bytearray holding whole top-level boxes (an init or media segment) in place
+        for box_type, start, body, end in iter_boxes(buf, 0, len(buf)):
+            if box_type == b'moov':
+                self.strip_moov(buf, body, end)
+            elif box_type == b'moof':
+                for child_type, child_start, child_body, child_end in iter_boxes(buf, body, end):
+                    if child_type == b'traf':
+                        self.decrypt_traf(buf, start, child_body, child_end)
+                    elif child_type == b'pssh':
+                        buf[child_start + 4:child_start + 8] = b'free'
+
+    def strip_moov(self, buf, body, end):
+        entry = None
+        def visit(box_type, start, body, end):
+            nonlocal entry
+            if box_type in MP4_SAMPLE_ENTRY_SIZES:
+                entry = start
+            elif box_type == b'frma' and entry is not None:
+                buf[entry + 4:entry + 8] = buf[body:body + 4]
+            elif box_type in (b'sinf', b'pssh'):
+                buf[start + 4:start + 8] = b'free'
+        walk_boxes(buf, body, end, visit)
+
+    def decrypt_traf(self, buf, moof_start, traf_body, traf_end):
+        track = None
+        base = moof_start
+        default_size = 0
+        samples = []
+        senc = None
+        for box_type, start, body, end in iter_boxes(buf, traf_body, traf_end):
+            flags = int.from_bytes(buf[body + 1:body + 4], 'big')
+            if box_type == b'tfhd':
+                track_id = struct.unpack_from('>I', buf, body + 4)[0]
+                track = self.tracks.get(track_id)
+                default_size = self.sample_sizes.get(track_id, 0)
+                pos = body + 8
+                if flags & 0x1:
+                    base = struct.unpack_from('>Q', buf, pos)[0]
+                    pos += 8
+                pos += 4 * bool(flags & 0x2) + 4 * bool(flags & 0x8)
+                if flags & 0x10:
+                    default_size = struct.unpack_from('>I', buf, pos)[0]
+            elif box_type == b'trun':
+                count = struct.unpack_from('>I', buf, body + 4)[0]
+                pos = body + 8
+                if flags & 0x1:
+                    data_pos = base + struct.unpack_from('>i', buf, pos)[0]
+                    pos += 4
+                else:
+                    data_pos = samples[-1][0] + samples[-1][1] if samples else base
+                pos += 4 * bool(flags & 0x4)
+                for _ in range(count):
+                    pos += 4 * bool(flags & 0x100)
+                    if flags & 0x200:
+                        size = struct.unpack_from('>I', buf, pos)[0]
+                        pos += 4
+                    else:
+                        size = default_size
+                    pos += 4 * bool(flags & 0x400) + 4 * bool(flags & 0x800)
+                    samples.append((data_pos, size))
+                    data_pos += size
+            elif box_type in (b'senc', b'saiz', b'saio', b'pssh'):
+                if box_type == b'senc':
+                    senc = (body, flags)
+                buf[start + 4:start + 8] = b'free'
+
+        if track is None:
+            return
+        if senc is None:
+            raise ValueError("protected fragment without a senc box")
+        pos, flags = senc
+        count = struct.unpack_from('>I', buf, pos + 4)[0]
+        pos += 8
+        iv_size = track['iv_size']
+        for offset, size in samples[:count]:
+            if offset + size > len(buf):
+                raise ValueError("sample data lies outside the segment")
+            iv = bytes(buf[pos:pos + iv_size]) if iv_size else track['constant_iv']
+            pos += iv_size
+            if flags & 0x2:
+                n = struct.unpack_from('>H', buf, pos)[0]
+                subsamples = [struct.unpack_from('>HI', buf, pos + 2 + 6 * i) for i in range(n)]
+                pos += 2 + 6 * n
+            else:
+                subsamples = [(0, size)]
+            self.decrypt_sample(track, buf, offset, subsamples, iv.ljust(16, b'\0'))
+
+    def decrypt_sample(self, track, buf, pos, subsamples, iv):
+        view = memoryview(buf)
+        aes = algorithms.AES(track['key'])
+        if track['scheme'] == b'cenc':
+            # A single CTR stream runs across all protected ranges of the sample
+            ctx = Cipher(aes, modes.CTR(iv)).decryptor()
+            for clear, protected in subsamples:
+                pos += clear
+                buf[pos:pos + protected] = ctx.update(view[pos:pos + protected])
+                pos += protected
+            return
+        # cbcs restarts CBC with the IV at each subsample, decrypts `crypt` blocks out of every
+        # crypt + skip and leaves a trailing partial block in the clear
+        for clear, protected in subsamples:
+            pos += clear
+            ctx = Cipher(aes, modes.CBC(iv)).decryptor()
+            blocks = protected // 16
+            run, step = (track['crypt'], track['crypt'] + track['skip']) if track['skip'] else (blocks, blocks)
+            for block in range(0, blocks, max(step, 1)):
+                start = pos + block * 16
+                stop = start + min(run, blocks - block) * 16
+                buf[start:stop] = ctx.update(view[start:stop])
+            pos += protected
 
 class MediaDownloader:
     def __init__(self, input_url, save_dir="downloads", save_name=None, thread_count=16, 
-                 headers=None, keys=None, proxy=None, auto_select=False, use_shaka=False, live_pipe_mux=False):
+                 headers=None, keys=None, proxy=None, auto_select=False, use_shaka=False, live_pipe_mux=False,
+                 inprocess_decrypt=True):
         self.input_url = input_url
         self.save_dir = save_dir
         self.save_name = save_name or "output"
@@ -29,40 +289,199 @@ class MediaDownloader:
         self.auto_select = auto_select
         self.use_shaka = use_shaka
         self.live_pipe_mux = live_pipe_mux
+        self.inprocess_decrypt = inprocess_decrypt
         
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
-        if self.proxy:
-            self.session.proxies = {'http': self.proxy, 'https': self.proxy}
+        self.session = self.new_session(self.thread_count)
+        self.local = threading.local()
+        # Set while handle_dash runs; shared by every large segment so range connections stay bounded
+        self.range_pool = None
         
         self.tmp_dir = os.path.join(self.save_dir, "tmp_" + self.save_name)
         os.makedirs(self.save_dir, exist_ok=True)
         os.makedirs(self.tmp_dir, exist_ok=True)
 
+    def new_session(self, pool_size):
+        session = requests.Session()
+        session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=5, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if self.proxy:
+            session.proxies = {'http': self.proxy, 'https': self.proxy}
+        return session
+
+    def thread_session(self):
+        # Each worker gets its own session so threads never contend on one urllib3 pool lock
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = self.new_session(4)
+        return session
+
     def log(self, level, msg):
         timestamp = time.strftime("%H:%M:%S", time.localtime())
-        print(f"{timestamp} {level} : {msg}")
+        # tqdm.write keeps the progress bar intact when a line is logged while it is shown
+        tqdm.write(f"{timestamp} {level} : {msg}")
 
-    def download_segment(self, url, path, pbar=None):
-        if os.path.exists(path):
-            if pbar: pbar.update(1)
+    def download_segment(self, url, path, exists=None):
+        if exists is None:
+            exists = os.path.exists(path)
+        if exists:
             return True
+        part_path = path + '.part'
         try:
-            resp = self.session.get(url, timeout=15)
-            resp.raise_for_status()
-            with open(path, 'wb') as f:
-                f.write(resp.content)
-            if pbar: pbar.update(1)
+            # Asking for the opening range makes a server that supports ranges report the full size up
+            # front, so a large segment can fetch the rest in parallel without dropping this connection
+            attempts = [None]
+            if self.range_pool:
+                attempts.insert(0, {'Range': f"bytes=0-{RANGE_SPLIT_SIZE - 1}", 'Accept-Encoding': 'identity'})
+            for headers in attempts:
+                with self.thread_session().get(url, headers=headers, stream=True, timeout=15) as resp:
+                    if headers and resp.status_code == 416:
+                        continue
+                    resp.raise_for_status()
+                    resp.raw.decode_content = True
+                    # Content-Length is the body size only when nothing is decoded on the way
+                    size = 0 if 'Content-Encoding' in resp.headers else int(resp.headers.get('Content-Length', 0))
+                    total = size
+                    if headers and resp.status_code == 206:
+                        content_range = parse_content_range(resp.headers.get('Content-Range'))
+                        if content_range and 'Content-Encoding' not in resp.headers and 'Content-Length' not in resp.headers:
+                            # A chunked 206 only tells its length through the span it covers
+                            size = content_range[1] - content_range[0] + 1
+                        if not content_range or content_range[:2] != (0, size - 1):
+                            # The answer doesn't line up with the range asked for; a plain GET always does
+                            continue
+                        total = content_range[2]
+                    with open(part_path, 'wb', buffering=0) as f:
+                        if total and hasattr(os, 'posix_fallocate'):
+                            # Reserve the whole segment up front so the filesystem lays it out in one extent
+                            with contextlib.suppress(OSError):
+                                os.posix_fallocate(f.fileno(), 0, total)
+                        shutil.copyfileobj(resp.raw, f, length=1024 * 1024)
+                        # The file is preallocated to full size, so a short body has to be caught here;
+                        # urllib3 before 2.0 does not enforce Content-Length itself
+                        if size and f.tell() != size:
+                            raise OSError(f"Body ended after {f.tell()} of {size} bytes")
+                break
+            if total > size:
+                self.download_rest(url, part_path, size, total)
+            # Only a complete body gets the final name, so resume never picks up a truncated file
+            os.replace(part_path, path)
             return True
         except Exception as e:
-            if pbar: pbar.update(1)
+            with contextlib.suppress(OSError):
+                os.remove(part_path)
             return False
 
-    def decrypt_file(self, encrypted_path, decrypted_path):
-        if not self.keys:
-            os.rename(encrypted_path, decrypted_path)
-            return True
+    def download_rest(self, url, part_path, start, total):
+        # The rest of a large segment comes down as parallel ranges: this worker fetches the last one and
+        # the shared range pool the others, so those connections are reused from segment to segment
+        count = min(RANGE_PARTS - 1, math.ceil((total - start) / RANGE_SPLIT_SIZE))
+        bounds = [start + (total - start) * i // count for i in range(count + 1)]
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            futures = [self.range_pool.submit(self.download_range, url, fd, lo, hi, total)
+                       for lo, hi in zip(bounds[:-2], bounds[1:-1])]
+            try:
+                self.download_range(url, fd, bounds[-2], bounds[-1], total)
+            finally:
+                # The pool writes into fd, so it stays open until every range has finished
+                concurrent.futures.wait(futures)
+            for fut in futures:
+                fut.result()
+        finally:
+            os.close(fd)
+
+    def download_range(self, url, fd, start, end, total):
+        headers = {'Range': f"bytes={start}-{end - 1}", 'Accept-Encoding': 'identity'}
+        with self.thread_session().get(url, headers=headers, stream=True, timeout=15) as resp:
+            resp.raise_for_status()
+            content_range = resp.headers.get('Content-Range')
+            if resp.status_code != 206 or parse_content_range(content_range) != (start, end - 1, total):
+                raise OSError(f"Range {start}-{end - 1} not honoured: {resp.status_code} {content_range!r}")
+            self.copy_range(resp.raw, fd, start, end)
 
+    def copy_range(self, raw, fd, offset, end):
+        while offset < end:
+            chunk = memoryview(raw.read(min(1024 * 1024, end - offset)))
+            if not chunk:
+                raise OSError("Connection closed before the range was complete")
+            while chunk:
+                written = os.pwrite(fd, chunk, offset)
+                chunk = chunk[written:]
+                offset += written
+
+    def download_in_order(self, executor, jobs):
+        # Yield (path, ok) in job order. At most 2 * thread_count downloads run at once; finished
+        # ones wait here for their turn, so one slow segment does not idle the workers behind it
+        running = {}
+        finished = {}
+        next_index = 0
+
+        def drain(limit):
+            nonlocal next_index
+            while len(running) > limit:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    index, path = running.pop(fut)
+                    finished[index] = (path, fut.result())
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+
+        for index, (url, path, exists) in enumerate(jobs):
+            running[executor.submit(self.download_segment, url, path, exists)] = (index, path)
+            yield from drain(self.thread_count * 2 - 1)
+        yield from drain(0)
+
+    def drop_cache(self, fd):
+        # A merged segment is never read again, so its pages need not stay in the page cache
+        if hasattr(os, 'posix_fadvise'):
+            with contextlib.suppress(OSError):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def append_file(self, outfile, path):
+        # outfile must be unbuffered: sendfile writes at the descriptor's offset, bypassing Python buffers
+        with open(path, 'rb', buffering=0) as infile:
+            size = os.fstat(infile.fileno()).st_size
+            offset = 0
+            try:
+                if hasattr(os, 'sendfile'):
+                    try:
+                        while offset < size:
+                            sent = os.sendfile(outfile.fileno(), infile.fileno(), offset, size - offset)
+                            if sent == 0:
+                                break
+                            offset += sent
+                        return
+                    except OSError:
+                        # Some platforms only sendfile to sockets; copy whatever was not sent yet
+                        infile.seek(offset)
+                shutil.copyfileobj(infile, outfile, length=4 * 1024 * 1024)
+            finally:
+                self.drop_cache(infile.fileno())
+
+    def load_decryptor(self, init_path):
+        with open(init_path, 'rb') as f:
+            init = bytearray(f.read())
+        try:
+            return CencDecryptor.from_init(init, self.keys)
+        except (ValueError, struct.error, IndexError, KeyError):
+            # Anything malformed in the init leaves the stream to the external tool
+            return None
+
+    def append_decrypted(self, outfile, path, decryptor):
+        with open(path, 'rb') as f:
+            buf = bytearray(f.read())
+            self.drop_cache(f.fileno())
+        try:
+            decryptor.process(buf)
+        except struct.error as e:
+            raise ValueError(f"truncated box: {e}")
+        outfile.write(buf)
+
+    def start_decrypt(self, encrypted_path, decrypted_path):
         if self.use_shaka:
             cmd = ["shaka-packager", "--enable_raw_key_decryption"]
             for k in self.keys:
@@ -78,115 +497,279 @@ class MediaDownloader:
                 cmd.extend(["--key", k])
             cmd.extend([encrypted_path, decrypted_path])
         
-        try:
-            subprocess.run(cmd, check=True, capture_output=True)
-            return True
-        except subprocess.CalledProcessError as e:
-            self.log("ERROR", f"Decryption failed: {e.stderr.decode()}")
+        # stderr goes to a scratch file, so nothing has to drain it while the tool runs
+        err = tempfile.TemporaryFile()
+        return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=err), err
+
+    def finish_decrypt(self, proc, err):
+        with err:
+            if proc.wait() == 0:
+                return True
+            # Only the tail is reported, enough to show why the tool failed
+            err.seek(max(0, err.seek(0, os.SEEK_END) - 8192))
+            self.log("ERROR", f"Decryption failed: {err.read().decode(errors='replace')}")
             return False
 
+    def decrypt_file(self, encrypted_path, decrypted_path):
+        return self.finish_decrypt(*self.start_decrypt(encrypted_path, decrypted_path))
+
+    def decrypt_segments(self, paths, merged_path, decrypted_path):
+        # Merge the kept segments into one encrypted file and decrypt it with the external tool
+        with open(merged_path, 'wb', buffering=0) as outfile:
+            for path in paths:
+                self.append_file(outfile, path)
+        return self.decrypt_file(merged_path, decrypted_path)
+
+    def open_pipe(self, fifo_path, proc):
+        # A blocking open would hang forever if the tool exits before opening its input, so poll instead
+        while True:
+            try:
+                fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO or proc.poll() is not None:
+                    return None
+                time.sleep(0.05)
+                continue
+            os.set_blocking(fd, True)
+            return open(fd, 'wb', buffering=0)
+
+    def save_stream(self, executor, pbar, existing, tmp_prefix, final_out, stype, key, urls, names, paths):
+        # Download one stream through the shared pool, merging and decrypting it as segments arrive
+        merged_path = f"{tmp_prefix}merged_{key}_enc.mp4"
+        decrypt = None
+        fallback = False
+        missing = []
+        jobs = ((url, path, name in existing) for url, path, name in zip(urls, paths, names))
+        results = self.download_in_order(executor, jobs)
+        # The init segment comes back first and tells whether the stream can be decrypted in process
+        init_path, init_ok = next(results)
+        decryptor = self.load_decryptor(init_path) if self.keys and self.inprocess_decrypt and init_ok else None
+        if decryptor:
+            self.log("INFO", f"Decrypting {stype} in process")
+        if not self.keys or decryptor:
+            # Nothing is left for an external tool, so segments go straight into the output
+            outfile = open(final_out, 'wb') if decryptor else open(final_out, 'wb', buffering=0)
+        elif self.live_pipe_mux and self.use_shaka and hasattr(os, 'mkfifo'):
+            # Stream the merge into shaka-packager through a FIFO instead of writing it out whole
+            fifo_path = f"{tmp_prefix}pipe_{key}.mp4"
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(fifo_path)
+            os.mkfifo(fifo_path)
+            decrypt = self.start_decrypt(fifo_path, final_out)
+            outfile = self.open_pipe(fifo_path, decrypt[0])
+        else:
+            outfile = open(merged_path, 'wb', buffering=0)
+        with outfile or contextlib.nullcontext():
+            # Append in order as segments finish so merging overlaps the download;
+            # progress is counted here rather than from every worker thread
+            for path, ok in itertools.chain([(init_path, init_ok)], results):
+                if not ok:
+                    missing.append(os.path.basename(path))
+                elif outfile:
+                    try:
+                        if decryptor:
+                            self.append_decrypted(outfile, path, decryptor)
+                        else:
+                            self.append_file(outfile, path)
+                    except BrokenPipeError:
+                        # The decrypt tool exited early; keep downloading so a rerun can resume
+                        outfile = None
+                    except ValueError as e:
+                        # Only the init segment was checked up front; the rest goes to the external tool
+                        self.log("ERROR", f"In-process decryption failed: {os.path.basename(path)}: {e}")
+                        outfile.close()
+                        outfile = None
+                        fallback = True
+                pbar.update(1)
+
+        if missing:
+            # Segments that did finish stay in tmp_dir, so a rerun only fetches these
+            self.log("ERROR", f"{len(missing)} {stype} segment(s) failed to download, output is incomplete: "
+                              f"{', '.join(missing[:10])}{' ...' if len(missing) > 10 else ''}")
+        if decrypt:
+            saved = self.finish_decrypt(*decrypt) and not missing
+            os.remove(fifo_path)
+            if not saved and not missing:
+                # The tool could not work from the pipe, but the kept segments still make a whole file
+                self.log("INFO", f"Retrying {stype} decryption from a merged file")
+                saved = self.decrypt_segments(paths, merged_path, final_out)
+        elif fallback:
+            # The partial output is useless; the kept segments give the tool a complete file
+            os.remove(final_out)
+            if not missing:
+                self.log("INFO", f"Decrypting {stype} with the external tool instead")
+            saved = not missing and self.decrypt_segments(paths, merged_path, final_out)
+        elif self.keys and not decryptor:
+            saved = not missing and self.decrypt_file(merged_path, final_out)
+        else:
+            saved = not missing
+        if saved:
+            self.log("INFO", f"Saved {stype} to {final_out}")
+            # The saved output replaces the segments, so only the final file stays on disk
+            for path in paths + [merged_path]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
     def handle_dash(self):
         self.log("INFO", f"Loading URL: {self.input_url}")
         try:
             resp = self.session.get(self.input_url)
             resp.raise_for_status()
-            mpd_text = resp.text
+            mpd_bytes = resp.content
         except Exception as e:
             self.log("ERROR", f"Failed to load MPD: {e}")
             return
 
-        if not mpd_text.strip():
+        if not mpd_bytes.strip():
             self.log("ERROR", "MPD content is empty. Check your proxy or URL.")
             return
 
         try:
-            root = ET.fromstring(mpd_text)
-        except ET.ParseError as e:
+            # Both parsers take the raw bytes and honour the XML encoding declaration, so requests never
+            # has to guess a charset; lxml's XMLSyntaxError and ET.ParseError are both SyntaxErrors
+            root = etree.fromstring(mpd_bytes, MPD_PARSER) if etree is not None else ET.fromstring(mpd_bytes)
+        except SyntaxError as e:
             self.log("ERROR", f"Failed to parse MPD XML: {e}")
             return
 
         # Handle namespaces
-        ns = {'mpd': 'urn:mpeg:dash:schema:mpd:2011'}
+        ns = {'mpd': MPD_NS}
         if 'xmlns' in root.attrib:
             ns['mpd'] = root.attrib['xmlns']
         
         self.log("INFO", "Content Matched: Dynamic Adaptive Streaming over HTTP")
+        if self.live_pipe_mux and not self.use_shaka:
+            self.log("INFO", "--live-pipe-mux needs --use-shaka-packager; mp4decrypt reads a seekable merged file instead")
         
         base_url_main = self.input_url.split('?')[0].rsplit('/', 1)[0] + '/'
         url_params = self.input_url.split('?', 1)[1] if '?' in self.input_url else ""
 
-        adaptation_sets = root.findall('.//mpd:AdaptationSet', ns)
+        xpaths = MPD_XPATHS if etree is not None and ns['mpd'] == MPD_NS else {}
+        def findall(el, path):
+            query = xpaths.get(path)
+            if query is not None: return query(el)
+            return el.findall(path, ns) if ns else el.findall(path.replace('mpd:', ''))
+        def find(el, path):
+            found = findall(el, path)
+            return found[0] if found else None
+
+        adaptation_sets = findall(root, './/mpd:AdaptationSet')
         if not adaptation_sets:
             # Try without namespace
-            adaptation_sets = root.findall('.//AdaptationSet')
-            ns = {}
+            ns, xpaths = {}, {}
+            adaptation_sets = findall(root, './/mpd:AdaptationSet')
+
+        period = find(root, 'mpd:Period')
+        presentation_duration = parse_duration((period.get('duration') if period is not None else None)
+                                               or root.get('mediaPresentationDuration'))
 
         selected_reps = []
         for aset in adaptation_sets:
-            reps = aset.findall('mpd:Representation', ns) if ns else aset.findall('Representation')
+            reps = findall(aset, 'mpd:Representation')
             if not reps: continue
             
             if self.auto_select:
                 best_rep = max(reps, key=lambda r: int(r.get('bandwidth', 0)))
                 selected_reps.append((aset, best_rep))
 
+        # One directory listing serves every resume check below
+        existing = {e.name for e in os.scandir(self.tmp_dir)}
+        tmp_prefix = self.tmp_dir + os.sep
+        plans = []
         for aset, rep in selected_reps:
             stype = aset.get('contentType') or ( 'video' if rep.get('width') else 'audio' )
             rid = rep.get('id')
             self.log("INFO", f"Selected {stype}: {rid} ({rep.get('bandwidth')} bps)")
             
-            template = rep.find('mpd:SegmentTemplate', ns) if ns else rep.find('SegmentTemplate')
+            template = find(rep, 'mpd:SegmentTemplate')
             if template is None:
-                template = aset.find('mpd:SegmentTemplate', ns) if ns else aset.find('SegmentTemplate')
+                template = find(aset, 'mpd:SegmentTemplate')
             
             if template is None: continue
             
-            init_url = template.get('initialization').replace('$RepresentationID$', str(rid))
+            fixed = {'RepresentationID': rid, 'Bandwidth': int(rep.get('bandwidth', 0))}
+            init_url = fill_template(template.get('initialization'), fixed)
             full_init_url = urljoin(base_url_main, init_url)
             if url_params: full_init_url += ('&' if '?' in full_init_url else '?') + url_params
             
-            init_path = os.path.join(self.tmp_dir, f"init_{stype}_{rid}.mp4")
-            self.download_segment(full_init_url, init_path)
-            
             seg_urls = []
-            timeline = template.find('mpd:SegmentTimeline', ns) if ns else template.find('SegmentTimeline')
+            media = fill_template(template.get('media'), fixed)
+            start_number = int(template.get('startNumber', 1))
+            # Only $Time$ and $Number$ are left; each maps to its exact token text and number format
+            tokens = {m.group(1): (m.group(0), m.group(2) or '%d') for m in TEMPLATE_TOKEN.finditer(media)}
+            number_token, number_fmt = tokens.get('Number', ('$Number$', '%d'))
+            token = None
+            timeline = find(template, 'mpd:SegmentTimeline')
             if timeline is not None:
-                current_time = 0
-                s_elements = timeline.findall('mpd:S', ns) if ns else timeline.findall('S')
+                times = []
+                t = 0
+                s_elements = findall(timeline, 'mpd:S')
                 for s in s_elements:
-                    t = int(s.get('t', current_time))
+                    t = int(s.get('t', t))
                     d = int(s.get('d', 0))
-                    r = int(s.get('r', 0))
-                    for i in range(r + 1):
-                        seg_url_part = template.get('media').replace('$RepresentationID$', str(rid)).replace('$Time$', str(t))
-                        full_seg_url = urljoin(base_url_main, seg_url_part)
-                        if url_params: full_seg_url += ('&' if '?' in full_seg_url else '?') + url_params
-                        seg_urls.append(full_seg_url)
-                        t += d
-                    current_time = t
-            
-            seg_paths = []
-            if seg_urls:
-                with tqdm(total=len(seg_urls), desc=f"Downloading {stype}") as pbar:
-                    with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_count) as executor:
-                        futures = []
-                        for i, url in enumerate(seg_urls):
-                            path = os.path.join(self.tmp_dir, f"seg_{stype}_{rid}_{i:05d}.m4s")
-                            seg_paths.append(path)
-                            futures.append(executor.submit(self.download_segment, url, path, pbar))
-                        concurrent.futures.wait(futures)
-            
-            merged_enc = os.path.join(self.tmp_dir, f"merged_{stype}_{rid}_enc.mp4")
-            with open(merged_enc, 'wb') as outfile:
-                if os.path.exists(init_path):
-                    with open(init_path, 'rb') as infile: outfile.write(infile.read())
-                for sp in seg_paths:
-                    if os.path.exists(sp):
-                        with open(sp, 'rb') as infile: outfile.write(infile.read())
+                    n = int(s.get('r', 0)) + 1
+                    # Expand the whole repeat run at C speed instead of one Python iteration per segment
+                    times.extend(range(t, t + d * n, d) if d else [t] * n)
+                    t += d * n
+
+                if 'Time' in tokens:
+                    token, time_fmt = tokens['Time']
+                    values = times if time_fmt == '%d' else [time_fmt % t for t in times]
+                else:
+                    token, values = number_token, [number_fmt % n for n in range(start_number, start_number + len(times))]
+            elif 'Number' in tokens and template.get('duration') and presentation_duration:
+                # Fixed-duration segments: the count follows from the presentation length
+                count = math.ceil(presentation_duration * int(template.get('timescale', 1)) / int(template.get('duration')))
+                token, values = number_token, [number_fmt % n for n in range(start_number, start_number + count)]
+
+            if token:
+                # Resolve the template once with the token still in place and fill values into the result;
+                # values are all digits, so if the first URL resolves like that, every URL does
+                head, found, tail = urljoin(base_url_main, media).partition(token)
+                if found and values and urljoin(base_url_main, media.replace(token, str(values[0]))) == f"{head}{values[0]}{tail}":
+                    suffix = (('&' if '?' in head + tail else '?') + url_params) if url_params else ''
+                    seg_urls = [f"{head}{v}{tail}{suffix}" for v in values]
+                else:
+                    seg_urls = [urljoin(base_url_main, media.replace(token, str(v))) for v in values]
+                    if url_params:
+                        seg_urls = [u + ('&' if '?' in u else '?') + url_params for u in seg_urls]
             
-            final_out = os.path.join(self.save_dir, f"{self.save_name}_{stype}.mp4")
-            self.decrypt_file(merged_enc, final_out)
-            self.log("INFO", f"Saved {stype} to {final_out}")
+            # The init segment is the first job, so it downloads alongside the first media segments
+            urls = [full_init_url] + seg_urls
+            # Every temp and output name derives from this key; Periods of a multi-Period MPD reuse
+            # representation ids, so a repeated type and id also gets the plan's index
+            key = f"{stype}_{rid}"
+            if any(plan[1] == key for plan in plans):
+                key = f"{key}_{len(plans)}"
+            names = [f"init_{key}.mp4"] + [f"seg_{key}_{i:05d}.m4s" for i in range(len(seg_urls))]
+            paths = [tmp_prefix + name for name in names]
+            plans.append((stype, key, urls, names, paths))
+
+        # Streams of one type (audio in two languages, say) would share an output name, so those use their key
+        stypes = [plan[0] for plan in plans]
+        outputs = [os.path.join(self.save_dir, f"{self.save_name}_{stype if stypes.count(stype) == 1 else key}.mp4")
+                   for stype, key, *_ in plans]
+        total = sum(len(plan[2]) for plan in plans)
+        # One bar covers every selected stream; redraws are throttled so per-segment updates stay cheap
+        with tqdm(total=total, desc="Downloading", mininterval=0.5, miniters=32, smoothing=0.05) as pbar:
+            # Ranges are written with os.pwrite, so without it segments always come down whole
+            self.range_pool = concurrent.futures.ThreadPoolExecutor(max_workers=RANGE_PARTS - 1) if hasattr(os, 'pwrite') else None
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_count) as executor, \
+                        concurrent.futures.ThreadPoolExecutor(max_workers=max(len(plans), 1)) as mergers:
+                    # All streams share the download workers, and each merges on its own thread, so
+                    # audio downloads alongside video and the pool never drains between streams
+                    streams = [mergers.submit(self.save_stream, executor, pbar, existing, tmp_prefix, final_out, *plan)
+                               for final_out, plan in zip(outputs, plans)]
+                    for stream in streams:
+                        stream.result()
+            finally:
+                if self.range_pool:
+                    self.range_pool.shutdown()
+                self.range_pool = None
+
+        with contextlib.suppress(OSError):
+            os.rmdir(self.tmp_dir)
 
     def run(self):
         if ".mpd" in self.input_url.split('?')[0]:
@@ -203,6 +786,7 @@ def main():
     parser.add_argument("--auto-select", action="store_true")
     parser.add_argument("--use-shaka-packager", action="store_true")
     parser.add_argument("--live-pipe-mux", action="store_true")
+    parser.add_argument("--no-inprocess-decrypt", dest="inprocess_decrypt", action="store_false")
     parser.add_argument("-H", "--header", action="append")
     
     args = parser.parse_args()
@@ -222,6 +806,7 @@ def main():
         auto_select=args.auto_select,
         use_shaka=args.use_shaka_packager,
         live_pipe_mux=args.live_pipe_mux,
+        inprocess_decrypt=args.inprocess_decrypt,
         headers=headers
     )
     downloader.run()
@@ -0,0 +1,200 @@
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import n_m3u8dl_re as m
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+KEY = bytes.fromhex('00112233445566778899aabbccddeeff')
+KID = bytes.fromhex('a1b2c3d4e5f60718293a4b5c6d7e8f90')
+KEYS = [f"{KID.hex()}:{KEY.hex()}"]
+TRACK_ID = 1
+
+
+def box(box_type, *payload):
+    body = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(body), box_type) + body
+
+
+def full_box(box_type, version, flags, *payload):
+    return box(box_type, bytes([version]) + flags.to_bytes(3, 'big'), *payload)
+
+
+def box_types(buf, start=0, end=None):
+    return [t for t, _, _, _ in m.iter_boxes(buf, start, len(buf) if end is None else end)]
+
+
+def make_init(scheme=b'cenc', iv_size=8, constant_iv=b'', crypt=0, skip=0, kid=KID, default_size=0,
+              tkhd_first=True, tenc_cut=0):
+    if scheme == b'cbcs':
+        tenc = full_box(b'tenc', 1, 0, b'\0', bytes([crypt << 4 | skip]), b'\1', bytes([iv_size]), kid,
+                        bytes([len(constant_iv)]) + constant_iv if not iv_size else b'')
+    else:
+        tenc = full_box(b'tenc', 0, 0, b'\0\0\1', bytes([iv_size]), kid)
+    if tenc_cut:
+        tenc = box(b'tenc', tenc[8:-tenc_cut])
+    sinf = box(b'sinf', box(b'frma', b'avc1'), full_box(b'schm', 0, 0, scheme, b'\0\1\0\0'), box(b'schi', tenc))
+    stsd = full_box(b'stsd', 0, 0, struct.pack('>I', 1), box(b'encv', bytes(78), sinf))
+    tkhd = full_box(b'tkhd', 0, 0, struct.pack('>III', 0, 0, TRACK_ID), bytes(68))
+    mdia = box(b'mdia', box(b'minf', box(b'stbl', stsd)))
+    trak = box(b'trak', tkhd, mdia) if tkhd_first else box(b'trak', mdia, tkhd)
+    mvex = box(b'mvex', full_box(b'trex', 0, 0, struct.pack('>IIIII', TRACK_ID, 1, 0, default_size, 0)))
+    pssh = full_box(b'pssh', 0, 0, bytes(16), b'\0\0\0\0')
+    return bytearray(box(b'ftyp', b'isom\0\0\0\0') + box(b'moov', trak, mvex, pssh))
+
+
+def protected_ranges(pos, subsamples):
+    for clear, protected in subsamples:
+        pos += clear
+        yield pos, pos + protected
+        pos += protected
+
+
+def encrypt_cenc(data, pos, subsamples, iv):
+    # All protected bytes of a sample form one CTR stream
+    ranges = list(protected_ranges(pos, subsamples))
+    stream = Cipher(algorithms.AES(KEY), modes.CTR(iv.ljust(16, b'\0'))).encryptor().update(
+        b''.join(bytes(data[a:b]) for a, b in ranges))
+    for a, b in ranges:
+        data[a:b], stream = stream[:b - a], stream[b - a:]
+
+
+def encrypt_cbcs(data, pos, subsamples, iv, crypt, skip):
+    # Each subsample is one CBC chain over its encrypted blocks; skipped and partial blocks stay clear
+    for a, b in protected_ranges(pos, subsamples):
+        blocks = [a + 16 * i for i in range((b - a) // 16)]
+        if skip:
+            blocks = [blk for i, blk in enumerate(blocks) if i % (crypt + skip) < crypt]
+        stream = Cipher(algorithms.AES(KEY), modes.CBC(iv)).encryptor().update(
+            b''.join(bytes(data[blk:blk + 16]) for blk in blocks))
+        for i, blk in enumerate(blocks):
+            data[blk:blk + 16] = stream[16 * i:16 * i + 16]
+
+
+def make_fragment(samples, ivs=None, subsamples=None, sizes_in_trun=True, senc=True):
+    # One moof + mdat; with subsamples None each sample is protected as a whole
+    def moof(data_offset):
+        trun_flags = 0x1 | (0x200 if sizes_in_trun else 0)
+        trun = full_box(b'trun', 0, trun_flags, struct.pack('>Ii', len(samples), data_offset),
+                        b''.join(struct.pack('>I', len(s)) for s in samples) if sizes_in_trun else b'')
+        tfhd_flags = 0x020000 | (0 if sizes_in_trun else 0x10)
+        tfhd = full_box(b'tfhd', 0, tfhd_flags, struct.pack('>I', TRACK_ID),
+                        b'' if sizes_in_trun else struct.pack('>I', len(samples[0])))
+        entries = b''
+        for i in range(len(samples)):
+            entries += ivs[i] if ivs else b''
+            if subsamples:
+                entries += struct.pack('>H', len(subsamples[i]))
+                entries += b''.join(struct.pack('>HI', c, p) for c, p in subsamples[i])
+        boxes = [tfhd, trun]
+        if senc:
+            boxes.append(full_box(b'senc', 0, 2 if subsamples else 0, struct.pack('>I', len(samples)), entries))
+        boxes.append(full_box(b'saiz', 0, 0, b'\0', struct.pack('>I', len(samples))))
+        boxes.append(full_box(b'saio', 0, 0, struct.pack('>II', 1, 0)))
+        return box(b'moof', full_box(b'mfhd', 0, 0, struct.pack('>I', 1)), box(b'traf', *boxes))
+
+    header = len(moof(0))
+    return bytearray(moof(header + 8) + box(b'mdat', *samples)), header + 8
+
+
+@unittest.skipIf(Cipher is None, "cryptography is not installed")
+class CencDecryptorTest(unittest.TestCase):
+    def setUp(self):
+        self.samples = [os.urandom(n) for n in (100, 333, 4096, 17)]
+
+    def check(self, init, fragment, mdat_pos):
+        decryptor = m.CencDecryptor.from_init(init, KEYS)
+        self.assertIsNotNone(decryptor)
+        init_size, fragment_size = len(init), len(fragment)
+        decryptor.process(init)
+        decryptor.process(fragment)
+        self.assertEqual(len(init), init_size)
+        self.assertEqual(len(fragment), fragment_size)
+        self.assertEqual(bytes(fragment[mdat_pos:]), b''.join(self.samples))
+
+        _, _, moov_body, moov_end = [b for b in m.iter_boxes(init, 0, len(init)) if b[0] == b'moov'][0]
+        seen = []
+        m.walk_boxes(init, moov_body, moov_end, lambda t, *_: seen.append(t))
+        self.assertIn(b'avc1', seen)
+        self.assertNotIn(b'encv', seen)
+        self.assertNotIn(b'sinf', seen)
+        self.assertNotIn(b'pssh', seen)
+
+        _, _, moof_body, moof_end = next(m.iter_boxes(fragment, 0, len(fragment)))
+        _, _, traf_body, traf_end = list(m.iter_boxes(fragment, moof_body, moof_end))[1]
+        self.assertEqual(box_types(fragment, traf_body, traf_end), [b'tfhd', b'trun', b'free', b'free', b'free'])
+
+    def test_cenc_subsamples(self):
+        ivs = [os.urandom(8) for _ in self.samples]
+        subsamples = [[(5, 40), (10, len(s) - 55)] if len(s) > 55 else [(len(s), 0)] for s in self.samples]
+        fragment, mdat_pos = make_fragment(self.samples, ivs, subsamples)
+        pos = mdat_pos
+        for sample, iv, subs in zip(self.samples, ivs, subsamples):
+            encrypt_cenc(fragment, pos, subs, iv)
+            pos += len(sample)
+        self.assertNotEqual(bytes(fragment[mdat_pos:]), b''.join(self.samples))
+        self.check(make_init(iv_size=8), fragment, mdat_pos)
+
+    def test_cenc_whole_samples_with_default_size(self):
+        self.samples = [os.urandom(64) for _ in range(5)]
+        ivs = [os.urandom(16) for _ in self.samples]
+        fragment, mdat_pos = make_fragment(self.samples, ivs, sizes_in_trun=False)
+        for i, iv in enumerate(ivs):
+            encrypt_cenc(fragment, mdat_pos + 64 * i, [(0, 64)], iv)
+        self.check(make_init(iv_size=16), fragment, mdat_pos)
+
+    def test_cbcs_pattern_with_constant_iv(self):
+        iv = os.urandom(16)
+        subsamples = [[(min(32, len(s)), len(s) - min(32, len(s)))] for s in self.samples]
+        fragment, mdat_pos = make_fragment(self.samples, subsamples=subsamples)
+        pos = mdat_pos
+        for sample, subs in zip(self.samples, subsamples):
+            encrypt_cbcs(fragment, pos, subs, iv, 1, 9)
+            pos += len(sample)
+        self.check(make_init(b'cbcs', iv_size=0, constant_iv=iv, crypt=1, skip=9), fragment, mdat_pos)
+
+    def test_cbcs_without_pattern(self):
+        iv = os.urandom(16)
+        fragment, mdat_pos = make_fragment(self.samples)
+        pos = mdat_pos
+        for sample in self.samples:
+            encrypt_cbcs(fragment, pos, [(0, len(sample))], iv, 0, 0)
+            pos += len(sample)
+        self.check(make_init(b'cbcs', iv_size=0, constant_iv=iv), fragment, mdat_pos)
+
+    def test_fragment_without_senc_raises(self):
+        decryptor = m.CencDecryptor.from_init(make_init(), KEYS)
+        fragment, _ = make_fragment(self.samples, senc=False)
+        with self.assertRaises(ValueError):
+            decryptor.process(fragment)
+
+    def test_unusable_init_needs_external_tool(self):
+        self.assertIsNone(m.CencDecryptor.from_init(make_init(kid=bytes(16)), KEYS))
+        self.assertIsNone(m.CencDecryptor.from_init(make_init(b'cens'), KEYS))
+        self.assertIsNotNone(m.CencDecryptor.from_init(make_init(kid=bytes(16)), [KEY.hex()]))
+
+    def test_malformed_init_needs_external_tool(self):
+        iv = os.urandom(16)
+        for init in (make_init(tkhd_first=False),
+                     make_init(tenc_cut=8),
+                     make_init(b'cbcs', iv_size=0, constant_iv=iv, tenc_cut=10)):
+            with self.assertRaises(ValueError):
+                m.CencDecryptor.from_init(init, KEYS)
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'init.mp4')
+                with open(path, 'wb') as f:
+                    f.write(init)
+                downloader = m.MediaDownloader('http://localhost/m.mpd', save_dir=tmp, keys=KEYS)
+                self.assertIsNone(downloader.load_decryptor(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import concurrent.futures
+import http.server
+import os
+import re
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import n_m3u8dl_re as m
+
+BODY = os.urandom(10000)
+SPLIT = 1000
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    # The path picks how the server answers a Range request:
+    # length (206 with Content-Length), chunked (206 without it), ignore (200 with the whole body),
+    # open (206 with an unknown total) and badtotal (later ranges report the wrong total)
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        mode = self.path.strip('/')
+        self.server.requests.append((mode, self.headers.get('Range')))
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+        if not match or mode == 'ignore':
+            return self.send_body(200, BODY, {})
+        first, last = int(match.group(1)), min(int(match.group(2)), len(BODY) - 1)
+        total = len(BODY) + (1 if mode == 'badtotal' and first else 0)
+        content_range = f"bytes {first}-{last}/{'*' if mode == 'open' else total}"
+        self.send_body(206, BODY[first:last + 1], {'Content-Range': content_range}, chunked=mode == 'chunked')
+
+    def send_body(self, status, body, headers, chunked=False):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(body), 300):
+                chunk = body[i:i + 300]
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+class RangeDownloadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.downloader = m.MediaDownloader('http://localhost/m.mpd', save_dir=tmp.name, thread_count=2)
+        self.downloader.range_pool = concurrent.futures.ThreadPoolExecutor(max_workers=m.RANGE_PARTS - 1)
+        self.addCleanup(self.downloader.range_pool.shutdown)
+        self.path = os.path.join(tmp.name, 'seg.m4s')
+        self.server.requests = []
+        patcher = mock.patch.object(m, 'RANGE_SPLIT_SIZE', SPLIT)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def download(self, mode):
+        return self.downloader.download_segment(f"http://127.0.0.1:{self.server.server_address[1]}/{mode}", self.path)
+
+    def assertSaved(self):
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), BODY)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    @unittest.skipUnless(hasattr(os, 'pwrite'), "ranges need os.pwrite")
+    def test_206_with_content_length_is_split_into_parts(self):
+        self.assertTrue(self.download('length'))
+        self.assertSaved()
+        ranges = sorted(int(r.split('=')[1].split('-')[0]) for _, r in self.server.requests)
+        # The opening range and then the remaining 9000 bytes as RANGE_PARTS - 1 parts
+        self.assertEqual(len(ranges), m.RANGE_PARTS)
+        self.assertEqual(ranges[:2], [0, SPLIT])
+
+    @unittest.skipUnless(hasattr(os, 'pwrite'), "ranges need os.pwrite")
+    def test_chunked_206_takes_its_size_from_content_range(self):
+        self.assertTrue(self.download('chunked'))
+        self.assertSaved()
+        self.assertTrue(all(r for _, r in self.server.requests))
+
+    def test_200_ignoring_range_is_saved_whole(self):
+        self.assertTrue(self.download('ignore'))
+        self.assertSaved()
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_unknown_total_retries_without_range(self):
+        self.assertTrue(self.download('open'))
+        self.assertSaved()
+        self.assertEqual([r for _, r in self.server.requests], [f"bytes=0-{SPLIT - 1}", None])
+
+    def test_without_range_pool_no_range_is_sent(self):
+        self.downloader.range_pool = None
+        self.assertTrue(self.download('length'))
+        self.assertSaved()
+        self.assertEqual([r for _, r in self.server.requests], [None])
+
+    @unittest.skipUnless(hasattr(os, 'pwrite'), "ranges need os.pwrite")
+    def test_mismatched_total_fails_the_segment(self):
+        self.assertFalse(self.download('badtotal'))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()